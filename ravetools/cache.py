@@ -0,0 +1,10 @@
+import os
+from pathlib import Path
+
+
+def cache_dir() -> Path:
+    # $XDG_CACHE_HOME/ravetools, usually ~/.cache/ravetools
+    path = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "ravetools"
+    path.mkdir(parents=True, exist_ok=True)
+
+    return path
@@ -1,28 +1,50 @@
 import unicodedata
 import re
+from functools import lru_cache
 
 import requests
 from requests.adapters import HTTPAdapter, Retry
 
 
 SEARCH_BASE = 'https://genius.com/api/search'
+UA = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:133.0) Gecko/20100101 Firefox/133.0'
+POOL_SIZE = 16
 
 
+# drop right single quotes and zero width spaces
+_STRIP_CHARS = {0x2019: None, 0x200b: None}
+
+
+@lru_cache(maxsize=8192)
 def _str_normalize(x):
-    return unicodedata.normalize('NFKC', x.translate({0x2019: None, 0x200b: None}).strip().lower())
+    return unicodedata.normalize('NFKC', x.translate(_STRIP_CHARS).strip().lower())
+
+
+def make_session(pool_size: int = POOL_SIZE) -> requests.Session:
+    # pooled keep-alive session so repeated hits to genius.com reuse the same TCP+TLS connection.
+    # `pool_size` should cover the threads sharing the session, or connections get thrown away
+    retries = Retry(total=5, backoff_factor=0.1)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    session.headers['User-Agent'] = UA
+
+    return session
+
+
+def search_key(title: str, artist: str) -> str:
+    return f'{_str_normalize(title)}\t{_str_normalize(artist)}'
 
 
 class Genius:
-    def __init__(self):
-        retries = Retry(total=5, backoff_factor=0.1)
-        adapter = HTTPAdapter(max_retries=retries)
-        self._session = requests.Session()
-        self._session.mount('http://', adapter)
-        self._session.mount('https://', adapter)
+    def __init__(self, pool_size: int = POOL_SIZE):
+        self._session = make_session(pool_size)
 
         title_skip_patterns = [
-            'track\\s?list',
-            'album art(work)?',
+            'track ?list',
+            'album ?art(?:work)?',
             'liner notes',
             'booklet',
             'credits',
@@ -31,7 +53,8 @@ class Genius:
             'instrumental',
             'setlist',
         ]
-        self._title_skip_re = re.compile('|'.join(f'({p})' for p in title_skip_patterns))
+        # one case-insensitive alternation, so titles don't need lowercasing before the search
+        self._title_skip_re = re.compile('|'.join(title_skip_patterns), re.IGNORECASE)
 
     def _get_json(self, url: str, **kwargs):
         return self._session.get(url, **kwargs).json()
@@ -46,31 +69,28 @@ class Genius:
 
         return resp
 
-    @staticmethod
-    def _title_matches(us: str, other: str) -> bool:
-        return _str_normalize(us) == _str_normalize(other)
-
     def _has_lyrics(self, song) -> bool:
         if song['lyrics_state'] != 'complete' or song.get('instrumental'):
             return False
 
         if self._title_skip_re.search(song['title']): return False
 
+        return True
 
     def search_song(self, title: str, artist: str):
         resp = self._search_type(f'{title} {artist}', 'song')
         hits = resp['response']['sections'][0]['hits']
 
-        # try to find an exact match
+        # try to find an exact match. if there isn't one, fall back to the first song which
+        # actually has lyrics. both are found in a single pass over the hits
+        title_norm = _str_normalize(title)
+        first_with_lyrics = None
         for song in hits:
             song = song['result']
-            if self._title_matches(song['title'], title):
+            if _str_normalize(song['title']) == title_norm:
                 return song
 
-        # couldn't find a title match. pick the first song which actually has lyrics
-        for song in hits:
-            song = song['result']
-            if self._has_lyrics(song):
-                return song
+            if first_with_lyrics is None and self._has_lyrics(song):
+                first_with_lyrics = song
 
-        return None
+        return first_with_lyrics
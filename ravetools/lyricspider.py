@@ -1,29 +1,41 @@
 import json
 import logging
+import re
 import sqlite3
+import threading
 import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
-from itertools import chain
-from multiprocessing import Process, Queue
+from functools import partial
 from os import PathLike
-from typing import Any, Callable, Iterable, Mapping
+from typing import Mapping
 
 import click
+import lxml.etree
+import lxml.html
 import rich.console
 import requests
 import spotipy
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 from spotipy.oauth2 import SpotifyOAuth
 from tqdm import tqdm
 
-from .genius import Genius
+from .genius import Genius, make_session, search_key
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
 
+def compress_text(text: str) -> bytes:
+    return zlib.compress(text.encode())
+
+
+def decompress_text(blob: bytes) -> str:
+    return zlib.decompress(blob).decode()
+
+
 class DB:
     MIGRATIONS = [
         # == MIGRATION 1: init ==
@@ -64,10 +76,54 @@ class DB:
             INSERT INTO lyrics_idx(rowid, lyrics) VALUES (new.id, new.lyrics);
         END;
         """,
+        # == MIGRATION 4: remember genius search outcomes, including misses ==
+        """
+        CREATE TABLE genius_search_cache (
+            key TEXT PRIMARY KEY, -- genius.search_key(title, artists)
+            genius_url TEXT, -- NULL if genius had nothing usable
+            fetched_at INTEGER NOT NULL
+        );
+        """,
+        # == MIGRATION 5: move the spotify metadata blob out of the hot tracks table ==
+        """
+        CREATE TABLE tracks_meta (
+            track_id INTEGER PRIMARY KEY REFERENCES tracks(id),
+            spotify_metadata BLOB NOT NULL -- zlib-compressed JSON
+        );
+
+        INSERT INTO tracks_meta(track_id, spotify_metadata)
+            SELECT id, compress_text(spotify_metadata) FROM tracks;
+        ALTER TABLE tracks DROP COLUMN spotify_metadata;
+        """,
+        # == MIGRATION 6: contentless FTS index, compressed lyrics ==
+        # the index no longer keeps its own copy of the text, and lyrics.lyrics holds
+        # compress_text() blobs. since the stored text is compressed, rows are indexed by
+        # the writer (see write_results) rather than by triggers
+        """
+        DROP TRIGGER idxtrig_lyrics_insert;
+        DROP TRIGGER idxtrig_lyrics_delete;
+        DROP TRIGGER idxtrig_lyrics_update;
+        DROP TABLE lyrics_idx;
+
+        CREATE VIRTUAL TABLE lyrics_idx USING fts5(
+            lyrics,
+            content='',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+        INSERT INTO lyrics_idx(rowid, lyrics) SELECT id, lyrics FROM lyrics;
+
+        UPDATE lyrics SET lyrics = compress_text(lyrics);
+        """,
     ]
 
     def __init__(self, database: str | bytes | PathLike[str] | PathLike[bytes]):
         self.conn = sqlite3.connect(database)
+        self.conn.create_function("compress_text", 1, compress_text, deterministic=True)
+        # WAL with synchronous=NORMAL only fsyncs at checkpoints rather than on every commit
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("PRAGMA temp_store = MEMORY")
+        self.conn.execute("PRAGMA mmap_size = 268435456")
 
     def cursor(self):
         return self.conn.cursor()
@@ -107,9 +163,15 @@ def cli(ctx, db, log_level):
 @click.option("--spotify-client-secret", envvar="SPOTIFY_CLIENT_SECRET")
 @click.option("--spotify-redirect-uri", envvar="SPOTIFY_REDIRECT_URI")
 @click.option("--page-size", default=25)
+@click.option("--commit-every", default=10, help="pages per transaction")
 @click.pass_context
 def sync(
-    ctx, spotify_client_id, spotify_client_secret, spotify_redirect_uri, page_size
+    ctx,
+    spotify_client_id,
+    spotify_client_secret,
+    spotify_redirect_uri,
+    page_size,
+    commit_every,
 ):
     """sync spotify saved song metadata to the local database."""
 
@@ -123,8 +185,11 @@ def sync(
     )
     sp = spotipy.Spotify(auth_manager=auth_manager)
 
-    with tqdm() as pbar:
+    # one transaction spans `commit_every` pages, so there's one commit per chunk of pages
+    # rather than one per page
+    with db.conn, tqdm() as pbar:
         offset = 0
+        n_pages = 0
         while True:
             res = sp.current_user_saved_tracks(limit=page_size, offset=offset)
             nitems = len(res["items"])
@@ -134,27 +199,39 @@ def sync(
             pbar.total = res["total"]
             pbar.update()
 
-            with db.conn:
-                cursor = db.conn.cursor()
-                cursor.executemany(
-                    """INSERT INTO tracks (
-                            spotify_id,
-                            title,
-                            artists,
-                            spotify_metadata
-                        ) VALUES (?, ?, ?, ?)
-                        ON CONFLICT(spotify_id) DO NOTHING
-                    """,
-                    [
-                        (
-                            item["track"]["id"],
-                            item["track"]["name"],
-                            ", ".join(a["name"] for a in item["track"]["artists"]),
-                            json.dumps(item["track"]),
-                        )
-                        for item in res["items"]
-                    ],
-                )
+            db.conn.executemany(
+                """INSERT INTO tracks (
+                        spotify_id,
+                        title,
+                        artists
+                    ) VALUES (?, ?, ?)
+                    ON CONFLICT(spotify_id) DO NOTHING
+                """,
+                [
+                    (
+                        item["track"]["id"],
+                        item["track"]["name"],
+                        ", ".join(a["name"] for a in item["track"]["artists"]),
+                    )
+                    for item in res["items"]
+                ],
+            )
+            db.conn.executemany(
+                """INSERT INTO tracks_meta (
+                        track_id,
+                        spotify_metadata
+                    ) SELECT id, ? FROM tracks WHERE spotify_id = ?
+                    ON CONFLICT(track_id) DO NOTHING
+                """,
+                [
+                    (compress_text(json.dumps(item["track"])), item["track"]["id"])
+                    for item in res["items"]
+                ],
+            )
+
+            n_pages += 1
+            if n_pages % commit_every == 0:
+                db.conn.commit()
 
             offset += nitems
             pbar.update(nitems)
@@ -167,55 +244,37 @@ class SpotifyTrackDetails:
     artists: str
 
 
-@dataclass
-class SearchResult:
-    track: SpotifyTrackDetails
-    genius_result: Any
-
-
 @dataclass
 class LyricsResult:
     track: SpotifyTrackDetails
-    genius_result: Any
+    genius_url: str | None
     lyrics: str
 
 
-genius_client = None
-
-
-def worker_genius_search(
-    delay: float, queue_track_details: Queue, queue_search_results: Queue
-):
-    global genius_client
-    if not genius_client:
-        genius_client = Genius()  # shared per process
-
-    logger.debug(f"[thread=genius search] booted; {genius_client=}")
-    while track_details := queue_track_details.get():
-        logger.debug(
-            f"[thread=genius search] got request to search for {track_details = }"
-        )
-        res = genius_client.search_song(
-            title=track_details.title, artist=track_details.artists
-        )
-        queue_search_results.put(SearchResult(track_details, res))
-        time.sleep(delay)
-
-
-def get_lyrics(session: requests.Session, search_res: SearchResult) -> LyricsResult:
-    if not search_res.genius_result:
-        # TODO: mark this as "no lyrics on genius" in the db so we
-        # don't constantly re-hit the search api endpoint for no reason
-        # when doing another lyricspider pull
+def refill_tokens(tokens: threading.Semaphore, rate: float, stop: threading.Event):
+    """
+    token bucket refill loop: hands one token back to `tokens` (a bounded semaphore shared
+    with the workers) every 1/rate seconds until `stop` is set. workers take a token per
+    request, so they only wait when they're actually going faster than `rate`
+    """
+    while not stop.wait(1 / rate):
+        try:
+            tokens.release()
+        except ValueError:
+            pass  # bucket is full
+
+
+def get_lyrics(session: requests.Session, genius_url: str) -> str | None:
+    resp = session.get(genius_url)
+    try:
+        tree = lxml.html.fromstring(resp.content)
+    except lxml.etree.ParserError:
+        # empty body, so certainly no lyrics in it
         return None
-
-    lyrics_page_url = search_res.genius_result["url"]
-
-    resp = session.get(lyrics_page_url)
-    bs = BeautifulSoup(resp.content, "lxml")
-    lyrics_chunks = []
-    for el_lyrics in bs.find_all(attrs={"data-lyrics-container": True}):
-        lyrics_chunks.append(el_lyrics.get_text("\n"))
+    lyrics_chunks = [
+        "\n".join(el_lyrics.itertext())
+        for el_lyrics in tree.xpath("//*[@data-lyrics-container]")
+    ]
 
     if not lyrics_chunks:
         # TODO: log this too - failure to find lyrics for a song that exists
@@ -224,45 +283,83 @@ def get_lyrics(session: requests.Session, search_res: SearchResult) -> LyricsRes
     return "\n".join(lyrics_chunks)
 
 
-def worker_genius_lyrics(
-    delay: float, queue_search_results: Queue, queue_lyrics_results: Queue
-):
-    logger.debug(f"[thread=genius lyrics] booted")
-    session = requests.Session()
-
-    while search_res := queue_search_results.get():
-        res = LyricsResult(
-            search_res.track, search_res.genius_result, get_lyrics(session, search_res)
+def process_track(
+    genius: Genius,
+    session: requests.Session,
+    search_cache: Mapping[str, str | None],
+    search_tokens: threading.Semaphore,
+    lyrics_tokens: threading.Semaphore,
+    track_details: SpotifyTrackDetails,
+) -> LyricsResult:
+    key = search_key(track_details.title, track_details.artists)
+    if key in search_cache:
+        genius_url = search_cache[key]
+    else:
+        logger.debug(f"[worker] searching for {track_details = }")
+        search_tokens.acquire()
+        res = genius.search_song(title=track_details.title, artist=track_details.artists)
+        genius_url = res["url"] if res else None
+
+    lyrics = None
+    if genius_url:
+        lyrics_tokens.acquire()
+        lyrics = get_lyrics(session, genius_url)
+
+    return LyricsResult(track_details, genius_url, lyrics)
+
+
+def write_results(db: DB, searches: list[tuple], lyrics: list[tuple]):
+    with db.conn:
+        # only fresh searches end up here; a re-searched miss replaces its old entry
+        db.conn.executemany(
+            """INSERT INTO genius_search_cache(key, genius_url, fetched_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE
+                SET genius_url = excluded.genius_url, fetched_at = excluded.fetched_at""",
+            searches,
+        )
+        db.conn.executemany(
+            "INSERT INTO lyrics(track_id, genius_url, lyrics) VALUES (?, ?, ?)",
+            [(tid, url, compress_text(text)) for tid, url, text in lyrics],
+        )
+        db.conn.executemany(
+            "INSERT INTO lyrics_idx(rowid, lyrics) SELECT id, ? FROM lyrics WHERE track_id = ?",
+            [(text, tid) for tid, _, text in lyrics],
         )
-        queue_lyrics_results.put(res)
-        time.sleep(delay)
-
 
-def make_pool(
-    n_workers: int,
-    target: Callable[..., object],
-    args: Iterable[Any] = (),
-    kwargs: Mapping[str, Any] = {},
-    **proc_kwargs,
-) -> list[Process]:
-    return [
-        Process(target=target, args=args, kwargs=kwargs, **proc_kwargs)
-        for _ in range(n_workers)
-    ]
+    searches.clear()
+    lyrics.clear()
 
 
 @cli.command()
 @click.pass_context
-@click.option("--n-search-workers", default=4)
-@click.option("--n-lyrics-workers", default=4)
-@click.option("--search-delay", default=0.1)
-@click.option("--lyrics-delay", default=0.1)
+@click.option("--n-workers", default=8, type=click.IntRange(min=1))
+@click.option(
+    "--search-rate",
+    default=10.0,
+    type=click.FloatRange(min=0, min_open=True),
+    help="genius searches per second",
+)
+@click.option(
+    "--lyrics-rate",
+    default=10.0,
+    type=click.FloatRange(min=0, min_open=True),
+    help="lyrics page fetches per second",
+)
+@click.option("--commit-every", default=64, help="lyrics per transaction")
+@click.option(
+    "--miss-ttl",
+    default=30.0,
+    type=click.FloatRange(min=0),
+    help="days before a search genius had nothing for is tried again",
+)
 def pull(
     ctx,
-    n_search_workers: int,
-    n_lyrics_workers: int,
-    search_delay: float,
-    lyrics_delay: float,
+    n_workers: int,
+    search_rate: float,
+    lyrics_rate: float,
+    commit_every: int,
+    miss_ttl: float,
 ):
     """
     download lyrics for all songs in the local database without them
@@ -270,70 +367,139 @@ def pull(
     db = ctx.obj["db"]
 
     # get tracks from db  (id, title, artists) columns on table tracks
-    #  send them to a queue to be looked up on the genius search api by worker threads
-    #  send these results to a queue to be queried from each `url` by beautifulsoup
-    # join on the result of these workers and (main thread) continually push them into sqlite
-    queue_track_details = Queue()
-    queue_search_results = Queue()
-    queue_lyrics_results = Queue()
-    search_workers = make_pool(
-        n_search_workers,
-        worker_genius_search,
-        args=(search_delay, queue_track_details, queue_search_results),
-    )
-    lyrics_workers = make_pool(
-        n_lyrics_workers,
-        worker_genius_lyrics,
-        args=(lyrics_delay, queue_search_results, queue_lyrics_results),
+    #  each worker thread searches genius for a track and then scrapes the lyrics from the
+    #  hit's `url`. this is all waiting on the network, so threads in this one process
+    #  share the http connection pools and the search cache without any ipc
+    # (main thread) continually push the results into sqlite
+    tracks = [
+        SpotifyTrackDetails(*row)
+        for row in db.conn.execute("""\
+            SELECT tracks.id, tracks.title, tracks.artists
+            FROM tracks
+            LEFT JOIN lyrics ON tracks.id = lyrics.track_id
+            WHERE lyrics.track_id IS NULL""")
+    ]
+
+    # hits are kept for good, but genius may have picked up a missed song since, so misses
+    # older than `miss_ttl` days are left out and searched again
+    search_cache = dict(
+        db.conn.execute(
+            """\
+            SELECT key, genius_url FROM genius_search_cache
+            WHERE genius_url IS NOT NULL OR fetched_at > ?""",
+            (int(time.time() - miss_ttl * 24 * 60 * 60),),
+        )
     )
-    for w in chain(search_workers, lyrics_workers):
-        w.start()
-
-    track_iter = db.conn.execute("""\
-        SELECT tracks.id, tracks.title, tracks.artists
-        FROM tracks
-        LEFT JOIN lyrics ON tracks.id = lyrics.track_id
-        WHERE lyrics.track_id IS NULL""")
-    for row in track_iter:
-        queue_track_details.put(SpotifyTrackDetails(*row))
-
-    n_tracks = db.conn.execute("""SELECT COUNT(*) FROM tracks LEFT JOIN lyrics ON tracks.id = lyrics.track_id
-        WHERE lyrics.track_id IS NULL""").fetchone()[0]
-
-    with tqdm(total=n_tracks) as pb:
-        while res := queue_lyrics_results.get():
-            pb.update(1)
-            if not res.lyrics:
+
+    # searches and lyrics fetches each share one token bucket across all workers
+    search_tokens = threading.BoundedSemaphore(n_workers)
+    lyrics_tokens = threading.BoundedSemaphore(n_workers)
+    stop_refill = threading.Event()
+    # daemons, so a stray refill thread can never keep the process alive on its own
+    refill_threads = [
+        threading.Thread(
+            target=refill_tokens,
+            args=(search_tokens, search_rate, stop_refill),
+            daemon=True,
+        ),
+        threading.Thread(
+            target=refill_tokens,
+            args=(lyrics_tokens, lyrics_rate, stop_refill),
+            daemon=True,
+        ),
+    ]
+
+    # results are written in chunks of `commit_every` lyrics, so one transaction (and one
+    # round of fts index updates) covers the whole chunk
+    pending_searches = []
+    pending_lyrics = []
+    executor = None
+    try:
+        for t in refill_threads:
+            t.start()
+
+        work = partial(
+            process_track,
+            # one pooled connection per worker
+            Genius(pool_size=n_workers),
+            make_session(pool_size=n_workers),
+            search_cache,
+            search_tokens,
+            lyrics_tokens,
+        )
+        executor = ThreadPoolExecutor(n_workers)
+        futures = {executor.submit(work, track): track for track in tracks}
+        for fut in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                res = fut.result()
+            except Exception:
+                # one bad track shouldn't stop the rest; it's picked up again next pull
+                logger.exception(f"failed to fetch lyrics for {futures[fut]}")
                 continue
-            tqdm.write(f"== LYRICS RESULT: {res}")
-            with db.conn:
-                db.conn.execute(
-                    "INSERT INTO lyrics(track_id, genius_url, lyrics) VALUES (?, ?, ?)",
-                    (res.track.tid, res.genius_result["url"], res.lyrics),
-                )
 
-    for w in chain(search_workers, lyrics_workers):
-        w.join()
+            key = search_key(res.track.title, res.track.artists)
+            if key not in search_cache:
+                pending_searches.append((key, res.genius_url, int(time.time())))
+            if res.lyrics:
+                tqdm.write(f"== LYRICS RESULT: {res}")
+                pending_lyrics.append((res.track.tid, res.genius_url, res.lyrics))
+
+            if len(pending_lyrics) >= commit_every:
+                write_results(db, pending_searches, pending_lyrics)
+    finally:
+        # don't keep working through the backlog if something went wrong, but do keep
+        # everything that was already fetched
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        stop_refill.set()
+        for t in refill_threads:
+            if t.is_alive():
+                t.join()
+        write_results(db, pending_searches, pending_lyrics)
+
+FTS_OPERATORS = {"AND", "OR", "NOT", "NEAR"}
+
+
+def query_terms_re(query: str) -> re.Pattern:
+    """
+    regex matching the words of an fts5 `query` (operators aside) in plain text. prefix
+    terms (`foo*`) match any word starting with `foo`
+    """
+    words = [
+        re.escape(term.rstrip("*")) + (r"\w*" if term.endswith("*") else r"\b")
+        for term in re.findall(r"\w+\*?", query)
+        if term not in FTS_OPERATORS
+    ]
+    if not words:
+        return re.compile(r"(?!)")
+
+    return re.compile(rf"\b(?:{'|'.join(words)})", re.IGNORECASE)
 
 
 @cli.command()
 @click.pass_context
+@click.option("--limit", default=50, help="maximum number of results")
 @click.argument("query")
-def search(ctx, query):
+def search(ctx, query, limit):
     db = ctx.obj["db"]
     c = rich.console.Console(highlight=False)
 
     t0 = time.perf_counter()
+    # pick the top `limit` matches by bm25 inside the fts index first, and only join those
     results = db.conn.execute(
         """\
-        SELECT
-            tracks.title, tracks.artists,
-            lyrics_idx.lyrics, highlight(lyrics_idx, 0, '<b>', '</b>')
-        FROM lyrics_idx
-        LEFT JOIN lyrics ON lyrics_idx.rowid=lyrics.id
-        LEFT JOIN tracks ON tracks.id=lyrics.track_id
-        WHERE lyrics_idx.lyrics MATCH ?""",
-        (query,),
+        SELECT tracks.title, tracks.artists, lyrics.lyrics
+        FROM (
+            SELECT rowid, rank
+            FROM lyrics_idx
+            WHERE lyrics_idx.lyrics MATCH ?
+            ORDER BY rank
+            LIMIT ?
+        ) AS top
+        JOIN lyrics ON lyrics.id=top.rowid
+        JOIN tracks ON tracks.id=lyrics.track_id
+        ORDER BY top.rank""",
+        (query, limit),
     ).fetchall()
     dt = time.perf_counter() - t0
 
@@ -341,11 +507,15 @@ def search(ctx, query):
         f"query: [magenta]`{query}`[/]. [blue]{len(results)}[/] ([blue]{dt:.8f}[/] seconds)`",
         highlight=False,
     )
-    for title, artists, _lyrics, highlighted_lyrics in results:
+    # the index is contentless, so highlight() isn't available. mark up the query's terms
+    # in the decompressed text instead
+    terms_re = query_terms_re(query)
+    for title, artists, lyrics in results:
         c.rule(f"{artists} - {title}")
         c.print(
-            rich.markup.escape(highlighted_lyrics)
-            .replace("<b>", "[bright_blue]")
-            .replace("</b>", "[/bright_blue]"),
+            terms_re.sub(
+                r"[bright_blue]\g<0>[/bright_blue]",
+                rich.markup.escape(decompress_text(lyrics)),
+            ),
             highlight=False,
         )
@@ -1,5 +1,11 @@
+import os
+import sqlite3
+import numpy as np
 import rapidfuzz
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
+from rapidfuzz.utils import default_process
 from pprint import pprint
 from dataclasses import dataclass
 from typing import Iterator, Any, Self
@@ -11,20 +17,34 @@ from spotipy.oauth2 import SpotifyOAuth
 from tinytag import TinyTag
 from jinja2 import Environment, PackageLoader, select_autoescape
 
+from .cache import cache_dir
+
 
 load_dotenv()
 
 type TrackInfo = dict
 
+PLAYLIST_PAGE_SIZE = 100 # max allowed by the api
+# just what SpotifyTrack.from_track reads
+PLAYLIST_TRACK_FIELDS = 'items(track(id,name,artists(name)))'
+PLAYLIST_FETCH_WORKERS = 5 # pages in flight at once; much more than this just earns 429s
+
 def fetch_playlist_items(sp: spotipy.Spotify, uri: str, fields = None) -> list[TrackInfo]:
-    offset = 0
-    tracks = []
-    while True:
-        res = sp.playlist_items(uri, offset=offset, fields=fields+',total' if fields else None)
-        if len(res['items']) == 0: break
+    fields = fields+',total' if fields else None
+    first = sp.playlist_items(uri, offset=0, limit=PLAYLIST_PAGE_SIZE, fields=fields)
+    tracks = first['items']
+
+    # the first page says how many items there are, so the rest can be requested at once
+    offsets = range(len(tracks), first['total'], PLAYLIST_PAGE_SIZE)
+    if not offsets: return tracks
+
+    def fetch_page(offset):
+        return sp.playlist_items(uri, offset=offset, limit=PLAYLIST_PAGE_SIZE, fields=fields)['items']
 
-        tracks.extend(res['items'])
-        offset = offset + len(res['items'])
+    with ThreadPoolExecutor(max_workers=PLAYLIST_FETCH_WORKERS) as executor:
+        # map yields in offset order regardless of which page lands first
+        for items in executor.map(fetch_page, offsets):
+            tracks.extend(items)
 
     return tracks
 
@@ -58,7 +78,8 @@ class SpotifyTrack(Track):
 @dataclass
 class CrateTrack(Track):
     path: Path
-    tags: TinyTag
+    # None when title and artist came out of the tag cache
+    tags: TinyTag | None
 
     @classmethod
     def from_file_tags(cls, path: Path, tags: TinyTag):
@@ -69,16 +90,78 @@ class CrateTrack(Track):
             tags=tags
         )
 
-def _read_crate(path) -> Iterator[CrateTrack]:
-    crate = Path(path)
-
-    for p in crate.iterdir():
-        if not p.is_file() or not p.suffix.lower() in TinyTag.SUPPORTED_FILE_EXTENSIONS: continue
-
-        yield CrateTrack.from_file_tags(p, TinyTag.get(p))
-
-def read_crate(*args, **kwargs) -> list[CrateTrack]:
-    return list(_read_crate(*args, **kwargs))
+_SUPPORTED_EXTENSIONS = frozenset(ext.lower() for ext in TinyTag.SUPPORTED_FILE_EXTENSIONS)
+
+TAG_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tags (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    title TEXT,
+    artist TEXT
+) WITHOUT ROWID
+"""
+
+def _crate_entries(path) -> Iterator[os.DirEntry]:
+    # scandir entries carry the file type from the directory read, so is_file() doesn't stat
+    with os.scandir(path) as it:
+        for entry in it:
+            if not entry.is_file(): continue
+            if os.path.splitext(entry.name)[1].lower() not in _SUPPORTED_EXTENSIONS: continue
+
+            yield entry
+
+def _read_track(path: str) -> CrateTrack:
+    return CrateTrack.from_file_tags(Path(path), TinyTag.get(path))
+
+def read_crate(path) -> list[CrateTrack]:
+    entries = list(_crate_entries(path))
+    keys = []
+    for entry in entries:
+        st = entry.stat()
+        keys.append((os.path.abspath(entry.path), st.st_mtime_ns, st.st_size))
+
+    # the cache only saves time. if it can't be opened, read or written (read-only home,
+    # locked db, ...), whatever it couldn't answer just gets parsed
+    cache = None
+    tracks = {}
+    try:
+        try:
+            # and don't sit around waiting on another run's lock for long
+            cache = sqlite3.connect(cache_dir() / 'tags.db', timeout=1)
+            cache.execute(TAG_CACHE_SCHEMA)
+
+            # tags only change along with the file, so files that look the same as last run
+            # are answered from the cache instead of being parsed again
+            for i, (entry, key) in enumerate(zip(entries, keys)):
+                row = cache.execute(
+                    'SELECT title, artist FROM tags WHERE path = ? AND mtime_ns = ? AND size = ?', key
+                ).fetchone()
+                if row is not None:
+                    tracks[i] = CrateTrack(title=row[0], artist=row[1], path=Path(entry.path), tags=None)
+        except (OSError, sqlite3.Error):
+            pass
+        misses = [i for i in range(len(entries)) if i not in tracks]
+
+        # tag reads are mostly waiting on disk, so overlap them in threads
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            for i, track in zip(misses, executor.map(_read_track, [entries[i].path for i in misses])):
+                tracks[i] = track
+
+        if cache is not None:
+            try:
+                with cache:
+                    cache.executemany(
+                        'INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?)',
+                        [(*keys[i], tracks[i].title, tracks[i].artist) for i in misses]
+                    )
+            except sqlite3.Error:
+                pass
+    finally:
+        if cache is not None:
+            cache.close()
+
+    return [tracks[i] for i in range(len(entries))]
 
 
 @dataclass
@@ -91,34 +174,99 @@ TITLE_MATCH_THRESHOLD = 70.0
 ARTIST_MATCH_THRESHOLD = 70.0
 N_POTENTIAL_MATCHES = 5
 
+def _process_artist(name: str | None) -> str:
+    # artists like '!!!' are nothing but punctuation, which default_process strips to ''. keep
+    # them lowercased instead, so they still only match themselves
+    if not name: return ''
+    return default_process(name) or name.lower()
+
 def reconcile(
     crate: list[CrateTrack],
     online: list[SpotifyTrack]
 ) -> Discrepancies:
-    online_names = [track.title for track in online]
-    online_only = set(range(len(online)))
-
-    pairs = []
-
-    for offline_item in crate:
-        potential_matches = rapidfuzz.process.extract(
-            offline_item.title,
+    # lowercase + strip punctuation once per string here, instead of per pair in the scorers
+    crate_titles = [default_process(track.title or '') for track in crate]
+    online_names = [default_process(track.title) for track in online]
+    crate_artists = [_process_artist(track.artist) for track in crate]
+    online_artists = [_process_artist(track.artist) for track in online]
+    if not online: return Discrepancies([], [])
+
+    # crate index -> online index
+    matches = {}
+
+    # tracks whose title and artist agree exactly once preprocessed need no fuzzy scoring.
+    # the first online track wins on duplicates, same as the fuzzy tiebreak below
+    online_by_key = {}
+    for idx, key in enumerate(zip(online_names, online_artists)):
+        online_by_key.setdefault(key, idx)
+    residual_crate = []
+    for i, (title, artist) in enumerate(zip(crate_titles, crate_artists)):
+        idx = online_by_key.get((title, artist)) if title and artist else None
+        if idx is None:
+            residual_crate.append(i)
+            continue
+        matches[i] = idx
+
+    if residual_crate:
+        # score every remaining crate title against every online title in one multithreaded
+        # call. online tracks that already have an exact match stay in, since several crate
+        # files can pair with the same track. anything under the threshold comes back as 0
+        title_scores = rapidfuzz.process.cdist(
+            [crate_titles[i] for i in residual_crate],
             online_names,
             scorer=rapidfuzz.fuzz.WRatio,
-            limit=N_POTENTIAL_MATCHES
+            processor=None,
+            score_cutoff=TITLE_MATCH_THRESHOLD,
+            workers=-1,
+            # keep the fractional part: uint8 would round distinct scores into ties and reorder candidates
+            dtype=np.float32,
         )
-        for _, score, idx in potential_matches:
-            if score < TITLE_MATCH_THRESHOLD: continue
-
-            matched_item = online[idx]
-            if offline_item.artist_match_score(matched_item) < ARTIST_MATCH_THRESHOLD:
-                continue
-
-            pairs.append((offline_item, matched_item))
-            online_only.discard(idx)
-            break
-
-    return Discrepancies(pairs, [online[i] for i in online_only])
+        # same for artists, so the candidate check below is just a lookup. artists repeat a lot,
+        # so only distinct names are scored
+        crate_artist_names, crate_artist_ids = np.unique(crate_artists, return_inverse=True)
+        online_artist_names, online_artist_ids = np.unique(online_artists, return_inverse=True)
+        artist_scores = rapidfuzz.process.cdist(
+            crate_artist_names,
+            online_artist_names,
+            scorer=rapidfuzz.fuzz.partial_ratio,
+            processor=None,
+            score_cutoff=ARTIST_MATCH_THRESHOLD,
+            workers=-1,
+            dtype=np.uint8,
+        )
+        # partial_ratio('', '') is 100, but an untagged crate file shouldn't match anyone
+        artist_scores[crate_artist_names == ''] = 0
+        # top N_POTENTIAL_MATCHES columns of each row, best score first and ties going to the
+        # earlier online track. scores are non-negative, so their float32 bit patterns sort like
+        # the scores do; packing the column in underneath makes every key in a row distinct, so
+        # the linear-time partition picks the same columns a stable full sort would
+        n_cols = title_scores.shape[1]
+        rank = title_scores.view(np.int32).astype(np.int64) * n_cols + (n_cols - 1 - np.arange(n_cols))
+        n_candidates = min(N_POTENTIAL_MATCHES, n_cols)
+        candidates = np.argpartition(rank, -n_candidates, axis=1)[:, -n_candidates:]
+        # then sort just those
+        order = np.argsort(-np.take_along_axis(rank, candidates, axis=1), axis=1)
+        candidates = np.take_along_axis(candidates, order, axis=1)
+        candidate_scores = np.take_along_axis(title_scores, candidates, axis=1)
+
+        # a candidate is usable if its artist agrees too. each row takes its first usable one,
+        # i.e. the best scoring title whose artist checks out
+        crate_rows = np.array(residual_crate)
+        online_cols = candidates
+        candidate_artist_scores = artist_scores[
+            crate_artist_ids[crate_rows][:, None],
+            online_artist_ids[online_cols],
+        ]
+        usable = (candidate_scores >= TITLE_MATCH_THRESHOLD) & (candidate_artist_scores >= ARTIST_MATCH_THRESHOLD)
+        first = usable.argmax(axis=1)
+        matched = usable[np.arange(len(first)), first]
+        matched_online = online_cols[matched, first[matched]].tolist()
+
+        matches.update(zip(crate_rows[matched].tolist(), matched_online))
+
+    pairs = [(crate[i], online[idx]) for i, idx in sorted(matches.items())]
+    online_only = set(range(len(online))).difference(matches.values())
+    return Discrepancies(pairs, [online[i] for i in sorted(online_only)])
 
 def discrep2txt(discrepancies):
     for offline, online in discrepancies.pairs:
@@ -127,11 +275,17 @@ def discrep2txt(discrepancies):
     for track in discrepancies.online_only:
         print(f'MISSING {track.artist} - {track.title} ({track.spotify_id})')
 
-def discrep2html(discrepancies, f):
-    env = Environment(loader=PackageLoader('ravetools'), autoescape=select_autoescape())
-    tmpl = env.get_template('index.html')
+@lru_cache(maxsize=None)
+def _html_template():
+    # built on first use rather than at import, and the shipped template never changes underneath us
+    env = Environment(loader=PackageLoader('ravetools'), autoescape=select_autoescape(), auto_reload=False)
+    return env.get_template('index.html')
 
-    f.write(tmpl.render(pairs=discrepancies.pairs, online_only=discrepancies.online_only))
+def discrep2html(discrepancies, f):
+    # write out as it renders instead of building the whole page in memory first
+    stream = _html_template().stream(pairs=discrepancies.pairs, online_only=discrepancies.online_only)
+    stream.enable_buffering(16)
+    stream.dump(f)
 
 
 @click.command()
@@ -151,7 +305,7 @@ def cli(spotify_client_id, spotify_client_secret, spotify_redirect_uri, playlist
     )
     sp = spotipy.Spotify(auth_manager=auth_manager)
 
-    playlist_items = fetch_playlist_items(sp, playlist_uri)
+    playlist_items = fetch_playlist_items(sp, playlist_uri, fields=PLAYLIST_TRACK_FIELDS)
     spotify_tracks = [SpotifyTrack.from_track(i['track']) for i in playlist_items]
 
     crate_tracks = read_crate(crate)
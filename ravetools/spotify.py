@@ -1,10 +1,19 @@
 from typing import Any
 import requests
 import json
+import os
+import tempfile
+import time
+from functools import lru_cache
+from requests.adapters import HTTPAdapter, Retry
+
+from .cache import cache_dir
 
 SPOTIFY_PARTNER_BASE = "https://api-partner.spotify.com"
 SPOTIFY_WEB_URL = "https://open.spotify.com"
 SPOTIFY_APP_VERSION = 896000000
+# don't reuse a cached token this close to expiring
+TOKEN_EXPIRY_MARGIN_MS = 60_000
 UA = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:133.0) Gecko/20100101 Firefox/133.0"
 
 # operationName=queryArtistOverview
@@ -12,26 +21,46 @@ UA = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:133.0) Gecko/20100101 Fir
 # &extensions={"persistedQuery":{"version":1,"sha256Hash":"4bc52527bb77a5f8bbb9afe491e9aa725698d29ab73bff58d49169ee29800167"}}
 
 
+@lru_cache
+def _persisted_query_extensions(query_hash: str) -> str:
+    # the same handful of queries get sent over and over, so only encode each once
+    return json.dumps(
+        {"persistedQuery": {"version": 1, "sha256Hash": query_hash}},
+        separators=(",", ":"),
+    )
+
+
 class WebplayerGQLClient:
     def __init__(self):
         self.session = requests.Session()
+        # keep connections to the api hosts open between queries, and back off on rate limits
+        self.session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=16,
+                pool_maxsize=32,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.2,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                ),
+            ),
+        )
 
-        self.refresh_token()
+        # reuse the last run's token while it's still good, saving a round trip per invocation
+        token = self._load_cached_token()
+        if token is None:
+            self.refresh_token()
+        else:
+            self._set_token(token)
 
     def _query(self, op_name: str, query_hash: str, variables: dict[str, Any]):
         resp = self.session.get(
             f"{SPOTIFY_PARTNER_BASE}/pathfinder/v1/query",
             params={
                 "operationName": op_name,
-                "variables": json.dumps(variables),
-                "extensions": json.dumps(
-                    {
-                        "persistedQuery": {
-                            "version": 1,
-                            "sha256Hash": query_hash,
-                        }
-                    }
-                ),
+                "variables": json.dumps(variables, separators=(",", ":")),
+                "extensions": _persisted_query_extensions(query_hash),
             },
             headers=self.headers,
         )
@@ -57,13 +86,63 @@ class WebplayerGQLClient:
             "spotify-app-version": str(SPOTIFY_APP_VERSION),
         }
 
+    def _set_token(self, token: dict[str, Any]):
+        self.client_id = token["clientId"]
+        self.access_token = token["accessToken"]
+        self.headers = self._build_headers()
+
+    def _load_cached_token(self) -> dict[str, Any] | None:
+        try:
+            with open(cache_dir() / "token.json") as f:
+                token = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # anything that doesn't look like what refresh_token saved is treated as no cache
+        try:
+            expires_at = token["accessTokenExpirationTimestampMs"]
+            valid = (
+                isinstance(token["clientId"], str)
+                and isinstance(token["accessToken"], str)
+                and isinstance(expires_at, int)
+                and not isinstance(expires_at, bool)
+            )
+        except (TypeError, KeyError):
+            return None
+
+        if not valid or expires_at - TOKEN_EXPIRY_MARGIN_MS < time.time() * 1000:
+            return None
+        return token
+
+    def _save_token(self, token: dict[str, Any]):
+        # write then rename, so a concurrent run never reads half a file. the cache is only
+        # a shortcut, so if it can't be written the token in memory is still good to use
+        tmp_path = None
+        try:
+            directory = cache_dir()
+            with tempfile.NamedTemporaryFile(
+                "w", dir=directory, prefix="token.", suffix=".tmp", delete=False
+            ) as f:
+                tmp_path = f.name
+                json.dump(token, f)
+            os.replace(tmp_path, directory / "token.json")
+            tmp_path = None
+        except OSError:
+            pass
+        finally:
+            # don't leave a half-written temp file behind, whatever went wrong
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
     def refresh_token(self):
         # anonymous token
         resp = self.session.get("https://open.spotify.com/get_access_token")
         resp_json = resp.json()
-        self.client_id = resp_json["clientId"]
-        self.access_token = resp_json["accessToken"]
-        self.headers = self._build_headers()
+        self._set_token(resp_json)
+        self._save_token(resp_json)
 
 
 if __name__ == "__main__":